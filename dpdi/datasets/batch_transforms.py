@@ -0,0 +1,81 @@
+"""Transforms applied to whole batches of images on the device.
+
+The LFW and IMDB-Wiki per-sample transforms, which run in the DataLoader
+workers, only resize and crop. With device_normalize set (the default for
+training and evaluation), they yield uint8 images, which are a quarter the size
+of float32 ones to collate, pin and copy to the device. These batches must then
+go through get_train_batch_transform() or get_test_batch_transform() once they
+are on the device, for the float conversion, augmentation and normalization.
+With device_normalize unset, the per-sample transforms instead yield
+unnormalized float images in [0, 1], e.g. for visualization.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+
+class RandomRotateCropFlip(torch.nn.Module):
+    """Randomly rotate, crop and horizontally flip each image in a batch.
+
+    This matches RandomRotation -> RandomCrop -> RandomHorizontalFlip applied
+    per-sample, but the three steps are composed into a single affine warp per image,
+    so the whole batch is resampled with one grid_sample call on whichever device
+    the batch lives on. Regions rotated in from outside the image are filled with
+    zeros, as in RandomRotation.
+    """
+
+    def __init__(self, degrees: float, crop_size):
+        super(RandomRotateCropFlip, self).__init__()
+        self.degrees = degrees
+        self.crop_size = crop_size
+
+    def forward(self, x):
+        b, c, h, w = x.shape
+        ch, cw = self.crop_size
+        device = x.device
+
+        angle = (torch.rand(b, device=device) * 2 - 1) * math.radians(self.degrees)
+        top = torch.randint(0, h - ch + 1, (b,), device=device).float()
+        left = torch.randint(0, w - cw + 1, (b,), device=device).float()
+        flip = torch.where(torch.rand(b, device=device) < 0.5,
+                           torch.full((b,), -1., device=device),
+                           torch.ones(b, device=device))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # All coordinates are normalized to [-1, 1] as in affine_grid. The crop maps
+        # output coordinates u to u * cw / w + tx in the rotated image; the rotation
+        # is applied in pixel units about the image center.
+        tx = (cw + 2 * left) / w - 1
+        ty = (ch + 2 * top) / h - 1
+        sx = flip * cw / w
+        sy = ch / h
+        theta = torch.stack([
+            torch.stack([cos * sx, -sin * sy * h / w, cos * tx - sin * ty * h / w], 1),
+            torch.stack([sin * sx * w / h, cos * sy, sin * tx * w / h + cos * ty], 1),
+        ], 1)
+        grid = F.affine_grid(theta, [b, c, ch, cw], align_corners=False)
+        out = F.grid_sample(x, grid, mode='nearest', padding_mode='zeros',
+                            align_corners=False)
+        if x.is_contiguous(memory_format=torch.channels_last):
+            out = out.contiguous(memory_format=torch.channels_last)
+        return out
+
+
+def get_train_batch_transform(mean, std, crop_size, degrees=30):
+    """Random augmentation and normalization of a batch of uint8 training images.
+
+    This is meant to be applied after the batch has been moved to the device.
+    """
+    return torch.nn.Sequential(
+        transforms.ConvertImageDtype(torch.float32),
+        RandomRotateCropFlip(degrees=degrees, crop_size=crop_size),
+        transforms.Normalize(mean=mean, std=std))
+
+
+def get_test_batch_transform(mean, std):
+    """Normalization of a batch of uint8 test images, applied on the device."""
+    return torch.nn.Sequential(
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize(mean=mean, std=std))
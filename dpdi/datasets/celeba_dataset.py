@@ -4,6 +4,7 @@ import os
 import numpy as np
 from torchvision.datasets.folder import default_loader
 from torchvision import transforms
+from dpdi.datasets.utils import FastToTensor
 
 
 def get_anno_df(attr_file, partition_file, partition, attribute_colname,
@@ -49,15 +50,15 @@ def get_celeba_transforms(partition: str, normalize: bool = True):
         crop_to_sq, resize,
         rotate, random_crop,
         flip_aug,
-        transforms.ToTensor(),
+        FastToTensor(),
         normalize_transf
     ])
 
     transform_test = transforms.Compose([crop_to_sq, resize, center_crop,
-                                         transforms.ToTensor(),
+                                         FastToTensor(),
                                          normalize_transf])
     transform_test_unnormalized = transforms.Compose([crop_to_sq, resize, center_crop,
-                                                      transforms.ToTensor()])
+                                                      FastToTensor()])
     if partition == 'train':
         assert normalize, "Unnormalized train transform not implemented."
         return transform_train
@@ -92,6 +93,9 @@ class CelebADataset(torch.utils.data.Dataset):
         self.loader = default_loader
         self.target_colname = target_colname
         self.attribute_colname = attribute_colname
+        self._img_names = self.anno.index.to_numpy()
+        self._targets = self.anno[self.target_colname].to_numpy()
+        self._attrs = self.anno[self.attribute_colname].to_numpy()
 
     def __len__(self):
         return len(self.anno)
@@ -101,10 +105,9 @@ class CelebADataset(torch.utils.data.Dataset):
             idx = idx.tolist()
 
         img_name = os.path.join(self.root_dir,
-                                self.anno.index[idx])
+                                self._img_names[idx])
         image = self.loader(img_name)
-        label_numpy = np.array(self.anno.iloc[idx, :][self.target_colname])
-        label = torch.from_numpy(label_numpy)
+        label = torch.from_numpy(np.asarray(self._targets[idx]))
 
         if self.transform:
             image = self.transform(image)
@@ -112,5 +115,5 @@ class CelebADataset(torch.utils.data.Dataset):
         return sample
 
     def get_attribute_annotations(self, idxs):
-        idx_annos = self.anno.iloc[idxs, :][self.attribute_colname]
+        idx_annos = self._attrs[np.asarray(idxs)]
         return idx_annos
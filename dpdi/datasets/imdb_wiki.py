@@ -1,18 +1,22 @@
 import torch
-import pandas as pd
 import os
 import numpy as np
-from torchvision.datasets.folder import default_loader
 from torchvision import transforms
 from scipy.io import loadmat
 from sklearn.model_selection import train_test_split
+from dpdi.datasets.utils import read_rgb_image, read_csv_cached, \
+    get_resize_transform, ImageFileDatasetMixin
+from tqdm import tqdm
 
 TRAIN_TEST_SPLIT_SEED = 948292
+# Images from meta.csv, resized and stacked into one uint8 array of shape
+# [N, 3, 80, 80] by pack_images().
+PACKED_IMAGES_FILENAME = "images_80x80.npy"
 
 
 def get_anno_df(root_dir, is_train):
     # root_dir = "/Users/jpgard/Documents/research/imdb-wiki"
-    meta_df = pd.read_csv(os.path.join(root_dir, "meta.csv"))
+    meta_df = read_csv_cached(os.path.join(root_dir, "meta.csv"))
     meta_df.replace({"male": 1, "female": 0}, inplace=True)
     train, test = train_test_split(meta_df, train_size=0.9,
                                    random_state=TRAIN_TEST_SPLIT_SEED)
@@ -22,94 +26,200 @@ def get_anno_df(root_dir, is_train):
         return test
 
 
-def get_transforms(is_train: bool, normalize: bool):
-    mu = [0.465727, 0.377981, 0.331473]
-    std = [0.286456, 0.254825, 0.248889]
-
-    resize = transforms.Resize([80,80])
-    rotate = transforms.RandomRotation(degrees=30)
-    crop_size = [64,64]
-    random_crop = transforms.RandomCrop(crop_size)  # Crops the training image
-    flip_aug = transforms.RandomHorizontalFlip()
-    normalize_transf = transforms.Normalize(mean=mu, std=std)
-    center_crop = transforms.CenterCrop(crop_size)  # Crops the test image
-
-    transform_train = transforms.Compose([resize, rotate, random_crop, flip_aug,
-                                          transforms.ToTensor(), normalize_transf])
-    trasform_test = transforms.Compose(
-        [resize, center_crop, transforms.ToTensor(), normalize_transf])
-    transform_test_unnormalized = transforms.Compose(
-        [resize, center_crop, transforms.ToTensor()])
+IMDB_WIKI_MEAN = [0.465727, 0.377981, 0.331473]
+IMDB_WIKI_STD = [0.286456, 0.254825, 0.248889]
+IMDB_WIKI_IMAGE_SIZE = [80, 80]
+IMDB_WIKI_CROP_SIZE = [64, 64]
+
+
+def get_transforms(is_train: bool, device_normalize: bool):
+    """Per-sample transforms, applied in the DataLoader workers.
+
+    See dpdi.datasets.batch_transforms for what device_normalize means.
+    """
+    to_float = transforms.ConvertImageDtype(torch.float32)
+    resize = get_resize_transform(IMDB_WIKI_IMAGE_SIZE)
+    center_crop = transforms.CenterCrop(IMDB_WIKI_CROP_SIZE)  # Crops the test image
+
+    transform_train = torch.nn.Sequential(resize)
+    trasform_test = torch.nn.Sequential(resize, center_crop)
+    transform_test_unnormalized = torch.nn.Sequential(to_float, resize, center_crop)
     if is_train:
-        assert normalize
+        assert device_normalize
         return transform_train
-    elif normalize:
+    elif device_normalize:
         return trasform_test
     else:
         return transform_test_unnormalized
 
 
-class IMDBWikiDataset(torch.utils.data.Dataset):
-    """The IMDB-Wiki dataset."""
+class _ResizedImageFiles(torch.utils.data.Dataset):
+    """Reads and resizes a list of image files; used to pack the dataset."""
+
+    def __init__(self, filepaths, size):
+        self.filepaths = filepaths
+        self.resize = get_resize_transform(size)
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def __getitem__(self, idx):
+        return self.resize(read_rgb_image(self.filepaths[idx]))
+
+
+def pack_images(root_dir, batch_size=256, num_workers=8):
+    """Write every image in meta.csv, resized to 80x80, to a single .npy file.
+
+    Rows of the array follow the row order of meta.csv. Reading from this file
+    (via use_packed_images=True) replaces one small random file read and JPEG
+    decode per sample with a slice of a memory-mapped array.
+    """
+    meta_df = read_csv_cached(os.path.join(root_dir, "meta.csv"))
+    filepaths = [os.path.join(root_dir, fp) for fp in meta_df["path"].values]
+    loader = torch.utils.data.DataLoader(_ResizedImageFiles(filepaths, IMDB_WIKI_IMAGE_SIZE),
+                                         batch_size=batch_size,
+                                         num_workers=num_workers)
+    out = np.lib.format.open_memmap(os.path.join(root_dir, PACKED_IMAGES_FILENAME),
+                                    mode="w+", dtype=np.uint8,
+                                    shape=(len(filepaths), 3, *IMDB_WIKI_IMAGE_SIZE))
+    start = 0
+    for batch in tqdm(loader):
+        out[start:start + len(batch)] = batch.numpy()
+        start += len(batch)
+    out.flush()
+    return
+
 
-    def __init__(self, root_dir, is_train: bool, normalize: bool, target_colname="age",
-                 attribute_colname="gender"):
+def check_packed_images(root_dir):
+    """Check that the array written by pack_images() still matches meta.csv.
+
+    Rows of the array are matched to annotations only by their position in
+    meta.csv, so an array packed from an older meta.csv would silently pair
+    samples with the wrong images.
+    """
+    packed_fp = os.path.join(root_dir, PACKED_IMAGES_FILENAME)
+    meta_fp = os.path.join(root_dir, "meta.csv")
+    if os.path.getmtime(packed_fp) < os.path.getmtime(meta_fp):
+        raise ValueError("{} is older than {}; rerun pack_imdb_wiki.py.".format(
+            packed_fp, meta_fp))
+    shape = np.load(packed_fp, mmap_mode='r').shape
+    expected_shape = (len(read_csv_cached(meta_fp)), 3, *IMDB_WIKI_IMAGE_SIZE)
+    if shape != expected_shape:
+        raise ValueError("{} has shape {} but meta.csv expects {}; rerun "
+                         "pack_imdb_wiki.py.".format(packed_fp, shape, expected_shape))
+
+
+class IMDBWikiDataset(ImageFileDatasetMixin, torch.utils.data.Dataset):
+    """The IMDB-Wiki dataset.
+
+    With device_normalize, images are uint8 and must be normalized on the device
+    with the batch transforms in dpdi.datasets.batch_transforms; otherwise they are
+    unnormalized floats in [0, 1].
+    """
+
+    def __init__(self, root_dir, is_train: bool, device_normalize: bool,
+                 target_colname="age", attribute_colname="gender",
+                 use_packed_images: bool = False, cache_images: bool = False):
         self.root_dir = root_dir
         self.is_train = is_train
-        self.normalize = normalize
+        self.device_normalize = device_normalize
         self.anno = get_anno_df(root_dir, is_train)
-        self.transform = get_transforms(is_train, normalize)
-        self.loader = default_loader
+        self.transform = get_transforms(is_train, device_normalize)
+        self.loader = read_rgb_image
         self.target_colname = target_colname
         self.attribute_colname = attribute_colname
         self.fp_colname = "path"
         self.majority_group_keys = (1,)
         self.minority_group_keys = (0,)
+        self.use_packed_images = use_packed_images
+        if use_packed_images:
+            check_packed_images(root_dir)
+        # Opened lazily, so that each DataLoader worker maps the file itself.
+        self._packed_images = None
+        # Positions in self.anno of the rows in the dataset; apply_alpha_to_dataset
+        # subsets these instead of copying self.anno.
+        self._active_idx = np.arange(len(self.anno))
+        self._cache_anno_columns()
+        # Not used with packed images, which are already decoded and resized.
+        self._init_image_cache(IMDB_WIKI_IMAGE_SIZE,
+                               cache_images and not use_packed_images)
+
+    def _cache_anno_columns(self):
+        """Cache the annotation columns of the active rows as numpy arrays."""
+        rows = self._active_idx
+        self._filepaths = self.anno[self.fp_colname].values[rows]
+        self._attributes = self.anno[self.attribute_colname].values[rows]
+        self._majority_idxs = np.flatnonzero(
+            np.isin(self._attributes, self.majority_group_keys))
+        self._minority_idxs = np.flatnonzero(
+            np.isin(self._attributes, self.minority_group_keys))
+        self._abs_paths = np.array([os.path.join(self.root_dir, fp)
+                                    for fp in self._filepaths])
+        self._targets = self.anno[self.target_colname].to_numpy(
+            dtype=np.float32)[rows].reshape(-1, 1)
+        # Row of each sample in meta.csv, and therefore in the packed images.
+        self._packed_idxs = self.anno.index.to_numpy()[rows]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_packed_images'] = None
+        return state
+
+    @property
+    def packed_images(self):
+        if self._packed_images is None:
+            self._packed_images = np.load(
+                os.path.join(self.root_dir, PACKED_IMAGES_FILENAME), mmap_mode='r')
+        return self._packed_images
+
+    @property
+    def packed_idxs(self):
+        return self._packed_idxs
 
     def __len__(self):
-        return len(self.anno)
+        return len(self._active_idx)
 
     @property
     def filepaths(self):
-        return self.anno[self.fp_colname].values
+        return self._filepaths
 
     @property
     def attributes(self):
-        return self.anno[self.attribute_colname].values
+        return self._attributes
 
     @property
     def targets(self):
-        return np.expand_dims(self.anno[self.target_colname].values, 1).astype(float)
+        return self._targets
 
     @property
     def majority_idxs(self):
-        return np.argwhere(np.isin(self.attributes, self.majority_group_keys)).flatten()
+        return self._majority_idxs
 
     @property
     def minority_idxs(self):
-        return np.argwhere(np.isin(self.attributes, self.minority_group_keys)).flatten()
+        return self._minority_idxs
 
-    def __getitem__(self, idx):
-        if torch.is_tensor(idx):
-            idx = idx.tolist()
+    def __getitems__(self, idxs):
+        # Slices of the packed array are cheap; only file reads go to the pool.
+        if self.use_packed_images:
+            return [self[idx] for idx in idxs]
+        return super(IMDBWikiDataset, self).__getitems__(idxs)
 
-        img_fp = os.path.join(self.root_dir, self.filepaths[idx])
-        image = self.loader(img_fp)
-        label = torch.from_numpy(self.targets[idx]).float()
+    def _load_image(self, idx):
+        if self.use_packed_images:
+            return torch.from_numpy(np.array(self.packed_images[self._packed_idxs[idx]]))
+        return super(IMDBWikiDataset, self)._load_image(idx)
 
-        if self.transform:
-            image = self.transform(image)
-        sample = (image, idx, label)
-        return sample
+    def _get_label(self, idx):
+        return torch.from_numpy(self._targets[idx])
 
     def get_attribute_annotations(self, idxs):
         try:
             idx_annos = self.attributes[idxs]
             return idx_annos
-        except Exception as e:
-            print("[WARNING] exception fetching annotation at idx {}: {}".format(idxs, (e)))
-            import ipdb;ipdb.set_trace()
-            # return np.array(default)
+        except IndexError as e:
+            raise IndexError(
+                "exception fetching annotation at idx {}: {}".format(idxs, e)) from e
 
     def apply_alpha_to_dataset(self, alpha, n_train):
         if alpha is not None:
@@ -129,12 +239,18 @@ class IMDBWikiDataset(torch.utils.data.Dataset):
             print(
                 "[DEBUG] sampling n_min={} elements from {} minority items {}".format(
                     n_min, len(self.minority_idxs), self.minority_group_keys))
-            sample_idx_1 = np.random.choice(self.majority_idxs, size=n_maj,
-                                            replace=False)
-            sample_idx_0 = np.random.choice(self.minority_idxs, size=n_min,
-                                            replace=False)
+            # This draws the same samples as np.random.choice(..., replace=False),
+            # which takes the head of a permutation, without its extra checks.
+            sample_idx_1 = self.majority_idxs[
+                np.random.permutation(len(self.majority_idxs))[:n_maj]]
+            sample_idx_0 = self.minority_idxs[
+                np.random.permutation(len(self.minority_idxs))[:n_min]]
             idx_sample = np.concatenate((sample_idx_1, sample_idx_0))
-            self.anno = self.anno.iloc[idx_sample]
+            self._active_idx = self._active_idx[idx_sample]
+            self._cache_anno_columns()
+            if self._image_cache is not None:
+                # The cache is keyed by position in the dataset, which has changed.
+                self.build_image_cache()
             assert len(self) == (n_min + n_maj), "Sanity check for self subsetting."
             assert abs(float(len(sample_idx_0)) / len(self) - (1 - alpha)) < \
                    0.001, "Sanity check for minority size within 0.001 of (1-alpha)."
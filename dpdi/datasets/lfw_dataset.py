@@ -2,37 +2,32 @@ import torch
 import torchvision
 from torchvision import transforms
 import pandas as pd
-import os
 import numpy as np
 from skimage import io
-from torchvision.datasets.folder import default_loader
 import glob
-import re
 import time
 from os import path as osp
-
-LFW_FILENAME_REGEX = re.compile("(\D+)_(\d{4})\.jpg")
+from dpdi.datasets.utils import read_rgb_image, read_csv_cached, \
+    get_resize_transform, ImageFileDatasetMixin
 
 LABEL_COLNAME = "label"
 ATTR_COLNAME = "attr"
 
 
-def extract_person_from_filename(x):
-    """Helper function to extract the person name from a LFW filename."""
-    res = re.match(LFW_FILENAME_REGEX, osp.basename(x))
-    try:
-        return res.group(1)
-    except AttributeError:
-        return None
-
+def parse_lfw_filename(x):
+    """Helper function to extract the (person, image number) from a LFW filename.
 
-def extract_imagenum_from_filename(x):
-    """Helper function to extract the image number from a LFW filename."""
-    res = re.match(LFW_FILENAME_REGEX, osp.basename(x))
-    try:
-        return res.group(2)
-    except AttributeError:
-        return None
+    LFW filenames have the form Person_Name_NNNN.jpg; returns (None, None) for
+    paths that do not.
+    """
+    stem = x[x.rfind(osp.sep) + 1:]
+    if not stem.endswith('.jpg'):
+        return None, None
+    person, _, imagenum = stem[:-4].rpartition('_')
+    if not (person and len(imagenum) == 4 and imagenum.isdigit()) \
+            or any(c.isdigit() for c in person):
+        return None, None
+    return person, imagenum
 
 
 def apply_thresh(df, colname, thresh: float, use_abs=True):
@@ -49,24 +44,27 @@ def get_anno_df(root_dir, partition, label_colname, label_threshold=None):
 
     train_fp = osp.join(root_dir, "peopleDevTrain.txt")
     test_fp = osp.join(root_dir, "peopleDevTest.txt")
-    anno_df = pd.read_csv(anno_fp, delimiter="\t")
+    anno_df = read_csv_cached(anno_fp, delimiter="\t")
     if label_threshold:
         anno_df = apply_thresh(anno_df, label_colname, label_threshold)
-    anno_df['imagenum_str'] = anno_df['imagenum'].apply(lambda x: f'{x:04}')
-    anno_df['person'] = anno_df['person'].apply(lambda x: x.replace(" ", "_"))
+    anno_df['imagenum_str'] = anno_df['imagenum'].astype(str).str.zfill(4)
+    anno_df['person'] = anno_df['person'].str.replace(" ", "_", regex=False)
     anno_df["img_basepath"] = (anno_df['person'] + '/' + anno_df['person'] + '_'
                                + anno_df['imagenum_str'] + '.jpg')
     anno_df["Mouth_Open"] = 1 - anno_df["Mouth_Closed"]
 
-    # Subset to the correct partition
+    # Subset to the correct partition. The first line of the partition files is the
+    # number of people; each following line is a person's name and image count.
     if partition == 'train':
-        partition_ids = pd.read_csv(train_fp, delimiter="\t", skiprows=0)
+        partition_fp = train_fp
     elif partition == 'test':
-        partition_ids = pd.read_csv(test_fp, delimiter="\t", skiprows=0)
+        partition_fp = test_fp
     else:
         raise ValueError
-    partition_idx = anno_df['person'].isin(partition_ids.index)
-    df_out = anno_df[partition_idx].reset_index().drop(columns='index')
+    partition_ids = pd.read_csv(partition_fp, delimiter="\t", skiprows=1,
+                                header=None, usecols=[0])[0].to_numpy()
+    partition_idx = np.isin(anno_df['person'].to_numpy(), partition_ids)
+    df_out = anno_df[partition_idx].reset_index(drop=True)
     return df_out
 
 
@@ -74,95 +72,90 @@ def make_lfw_file_pattern(dirname):
     return osp.join(dirname, "*/*.jpg")
 
 
-def get_lfw_transforms(partition, normalize:bool=True):
-    mu_data = [0.463666, 0.390829, 0.339801]
-    std_data = [0.282721, 0.253934, 0.247486]
-    im_size = [80, 80]
-    crop_size = [64, 64]
+LFW_MEAN = [0.463666, 0.390829, 0.339801]
+LFW_STD = [0.282721, 0.253934, 0.247486]
+LFW_IMAGE_SIZE = [80, 80]
+LFW_CROP_SIZE = [64, 64]
+
 
-    resize = transforms.Resize(im_size)
-    rotate = transforms.RandomRotation(degrees=30)
-    random_crop = transforms.RandomCrop(crop_size)  # Crops the training image
-    flip_aug = transforms.RandomHorizontalFlip()
-    normalize_aug = transforms.Normalize(mean=mu_data, std=std_data)
-    center_crop = transforms.CenterCrop(crop_size)  # Crops the test image
+def get_lfw_transforms(partition, device_normalize: bool = True):
+    """Per-sample transforms, applied in the DataLoader workers.
 
-    transform_train = transforms.Compose([resize,
-                                          rotate, random_crop,
-                                          flip_aug,
-                                          transforms.ToTensor(),
-                                          normalize_aug])
-    transform_test = transforms.Compose([resize, center_crop,
-                                         transforms.ToTensor(),
-                                         normalize_aug])
+    See dpdi.datasets.batch_transforms for what device_normalize means.
+    """
+    im_size = LFW_IMAGE_SIZE
 
-    transform_test_unnormalized = transforms.Compose([resize, center_crop,
-                                         transforms.ToTensor()])
+    to_float = transforms.ConvertImageDtype(torch.float32)
+    resize = get_resize_transform(im_size)
+    center_crop = transforms.CenterCrop(LFW_CROP_SIZE)  # Crops the test image
+
+    # These are not scripted: scripted modules cannot be pickled, which DataLoader
+    # workers started with spawn (the default on macOS and Windows) require.
+    transform_train = torch.nn.Sequential(resize)
+    transform_test = torch.nn.Sequential(resize, center_crop)
+
+    transform_test_unnormalized = torch.nn.Sequential(to_float, resize, center_crop)
 
 
     if partition == 'train':
         return transform_train
     elif partition == 'test':
-        if not normalize:
+        if not device_normalize:
             return transform_test_unnormalized
         return transform_test
     else:
         raise ValueError("Invalid partition {}".format(partition))
 
 
-class LFWDataset(torch.utils.data.Dataset):
+class LFWDataset(ImageFileDatasetMixin, torch.utils.data.Dataset):
     """LFW Dataset."""
 
     def __init__(self, root_dir, target_colname, attribute_colname,
                  label_threshold,
                  transform=None,
-                 partition='train', image_subdirectory="lfw-deepfunneled"
+                 partition='train', image_subdirectory="lfw-deepfunneled",
+                 cache_images: bool = False
                  ):
         """
         Args:
             attr_file (string): Path to the file with annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
-                on a sample.
+                on a sample. The train and test transforms from
+                get_lfw_transforms() yield uint8 images that still have to be
+                normalized on the device; see dpdi.datasets.batch_transforms.
+            cache_images (bool): keep each image, decoded and resized to
+                LFW_IMAGE_SIZE, in a SharedImageCache after it is first read.
         """
         self.anno = get_anno_df(root_dir, partition, target_colname, label_threshold)
         self.root_dir = root_dir
         self.transform = transform
-        self.loader = default_loader
+        self.loader = read_rgb_image
         self.target_colname = target_colname
         self.attribute_colname = attribute_colname
         self.threshold=label_threshold
 
         self.image_subdirectory = image_subdirectory
+        # Cache the columns read in __getitem__ to avoid per-item pandas indexing.
+        image_dir = osp.join(root_dir, image_subdirectory, '')
+        self._abs_paths = (image_dir + self.anno['img_basepath']).to_numpy()
+        self._targets = self.anno[self.target_colname].to_numpy()
+        self._attrs = self.anno[self.attribute_colname].to_numpy()
+        self._init_image_cache(LFW_IMAGE_SIZE, cache_images)
 
     def __len__(self):
         return len(self.anno)
 
-    def __getitem__(self, idx):
-        if torch.is_tensor(idx):
-            idx = idx.tolist()
-        img_name = os.path.join(self.root_dir, self.image_subdirectory,
-                                self.anno['img_basepath'].iloc[idx])
-        image = self.loader(img_name)
-        soft_labels = self.anno.iloc[idx, :][self.target_colname]
+    def _get_label(self, idx):
+        soft_labels = self._targets[idx]
         # Cast labels to 1 if > 0, and zero otherwise
-        hard_labels = (soft_labels > 0).astype(int)
-        label_numpy = np.array(hard_labels)
-        label = torch.from_numpy(label_numpy)
-
-        if self.transform:
-            image = self.transform(image)
-        sample = (image, idx, label)
-        return sample
+        return torch.from_numpy(np.asarray(soft_labels > 0, dtype=np.int64))
 
     def get_attribute_annotations(self, idxs):
-        idx_annos = self.anno.iloc[idxs, :][self.attribute_colname]
-        def _revalue_fn(x):
-            if x < -self.threshold:
-                return 0
-            if x > self.threshold:
-                return 1
-            else:
-                return np.nan
-        idx_annos = idx_annos.apply(_revalue_fn)
-        return idx_annos
+        """Binarize the attribute at idxs: 1 above threshold, 0 below -threshold,
+        and nan in between."""
+        idx_annos = self._attrs[np.asarray(idxs)]
+        out = np.full(idx_annos.shape, np.nan)
+        out[idx_annos > self.threshold] = 1
+        out[idx_annos < -self.threshold] = 0
+        return out
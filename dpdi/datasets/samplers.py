@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+
+
+class ChunkShuffleSampler(torch.utils.data.Sampler):
+    """Approximate shuffling that reads the underlying storage in contiguous chunks.
+
+    The dataset indices are ordered by their position in storage and split into
+    chunks of chunk_size. Each epoch visits the chunks in random order,
+    chunks_per_buffer at a time, and yields the indices of each group of chunks
+    in random order. Reads are then confined to a few contiguous regions at a
+    time instead of being spread uniformly over the whole file.
+    """
+
+    def __init__(self, storage_idxs, chunk_size: int, chunks_per_buffer: int):
+        """
+        Args:
+            storage_idxs: array where storage_idxs[i] is the storage position of
+                dataset element i.
+            chunk_size: number of contiguous elements in a chunk.
+            chunks_per_buffer: number of chunks shuffled together.
+        """
+        self.storage_order = np.argsort(storage_idxs, kind='stable')
+        self.chunk_size = chunk_size
+        self.chunks_per_buffer = chunks_per_buffer
+
+    def __len__(self):
+        return len(self.storage_order)
+
+    def __iter__(self):
+        chunks = np.split(self.storage_order, range(
+            self.chunk_size, len(self.storage_order), self.chunk_size))
+        chunk_order = np.random.permutation(len(chunks))
+        for i in range(0, len(chunks), self.chunks_per_buffer):
+            buffer = np.concatenate(
+                [chunks[j] for j in chunk_order[i:i + self.chunks_per_buffer]])
+            yield from np.random.permutation(buffer).tolist()
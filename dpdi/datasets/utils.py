@@ -1,4 +1,23 @@
+import errno
+import hashlib
+import inspect
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+from torchvision.io import read_image
+
+# Number of threads each process uses to read and decode images in __getitems__.
+READ_POOL_THREADS = 4
+
+_read_pool = None
+_read_pool_pid = None
 
 
 def normalize_columns(data, exclude_cols=('sensitive', 'target')):
@@ -6,3 +25,266 @@ def normalize_columns(data, exclude_cols=('sensitive', 'target')):
         if (x != 'sensitive' and x != 'target'):
             data[x] = (data[x] - np.mean(data[x])) / np.std(data[x])
     return data
+
+
+def read_csv_cached(fp, **read_csv_kwargs):
+    """pd.read_csv, with the parsed DataFrame cached as a pickle next to fp.
+
+    Loading the pickle skips CSV tokenizing, which dominates the load time of
+    large annotation files. The cache is keyed on the read_csv arguments and is
+    rebuilt whenever fp is newer than it, or cannot be loaded (e.g. it was written
+    by an incompatible pandas version). If the cache cannot be written (e.g. a
+    read-only data directory), the parsed DataFrame is returned uncached.
+    """
+    key = hashlib.md5(repr(sorted(read_csv_kwargs.items())).encode()).hexdigest()[:8]
+    cache_fp = "{}.{}.pkl".format(fp, key)
+    if os.path.exists(cache_fp) and os.path.getmtime(cache_fp) >= os.path.getmtime(fp):
+        try:
+            return pd.read_pickle(cache_fp)
+        except Exception as e:
+            print("[WARNING] could not load cache {}, rebuilding it: {}".format(
+                cache_fp, e))
+    df = pd.read_csv(fp, **read_csv_kwargs)
+    # Write to a temporary file first so that a concurrent reader never sees a
+    # partially-written cache.
+    tmp_fp = "{}.{}.tmp".format(cache_fp, os.getpid())
+    try:
+        df.to_pickle(tmp_fp)
+        os.replace(tmp_fp, cache_fp)
+    except OSError as e:
+        print("[WARNING] could not cache {} to {}: {}".format(fp, cache_fp, e))
+        try:
+            os.remove(tmp_fp)
+        except OSError:
+            pass
+    return df
+
+
+def read_rgb_image(path):
+    """Read an image file into a uint8 tensor of shape [3, H, W].
+
+    This decodes with torchvision's libjpeg-based reader instead of PIL; grayscale
+    images are expanded to three channels, matching PIL's convert('RGB').
+    """
+    image = read_image(path)
+    if image.shape[0] == 1:
+        image = image.expand(3, -1, -1)
+    return image
+
+
+def get_resize_transform(size):
+    """Return a transform resizing [C, H, W] image tensors to size, with antialiasing.
+
+    transforms.Resize only antialiases PIL images, unless it is given antialias=True
+    (torchvision >= 0.10). Without antialiasing, downscaling decoded images by 3x or
+    more aliases badly and no longer matches the PIL-resized images that the
+    dataset mean/std constants were computed on. On older torchvision, images are
+    downscaled by area averaging instead.
+    """
+    if 'antialias' in inspect.signature(transforms.Resize).parameters:
+        return transforms.Resize(size, antialias=True)
+    return _AreaResize(size)
+
+
+class _AreaResize(torch.nn.Module):
+    """Resize by area averaging when downscaling, and bilinearly otherwise."""
+
+    def __init__(self, size):
+        super(_AreaResize, self).__init__()
+        self.size = list(size)
+
+    def forward(self, img):
+        h, w = img.shape[-2:]
+        x = img.unsqueeze(0).float()
+        if h >= self.size[0] and w >= self.size[1]:
+            x = F.interpolate(x, size=self.size, mode='area')
+        else:
+            x = F.interpolate(x, size=self.size, mode='bilinear', align_corners=False)
+        x = x.squeeze(0)
+        if img.dtype == torch.uint8:
+            x = x.round_().clamp_(0, 255)
+        return x.to(img.dtype)
+
+    def __repr__(self):
+        return "{}(size={})".format(self.__class__.__name__, self.size)
+
+
+def get_read_pool():
+    """Return this process's image-reading thread pool, creating it if needed.
+
+    The pool is keyed on the process id, so that each forked DataLoader worker
+    starts its own threads instead of inheriting a dead pool from the parent.
+    """
+    global _read_pool, _read_pool_pid
+    if _read_pool is None or _read_pool_pid != os.getpid():
+        _read_pool = ThreadPoolExecutor(max_workers=READ_POOL_THREADS)
+        _read_pool_pid = os.getpid()
+    return _read_pool
+
+
+def collate_channels_last(batch):
+    """Collate (image, idx, label) samples into a channels-last image batch.
+
+    The images are copied directly into one preallocated [B, C, H, W] tensor with
+    channels-last strides, rather than stacked into a contiguous batch that the
+    model would have to permute. As in default_collate, the batch is allocated in
+    shared memory when collating inside a DataLoader worker.
+    """
+    images, idxs, labels = zip(*batch)
+    elem = images[0]
+    c, h, w = elem.shape
+    numel = len(images) * c * h * w
+    if torch.utils.data.get_worker_info() is not None:
+        if hasattr(elem, 'untyped_storage'):
+            storage = elem.untyped_storage()._new_shared(numel * elem.element_size())
+        else:  # torch < 2.0
+            storage = elem.storage()._new_shared(numel)
+        out = elem.new(storage)
+    else:
+        out = elem.new_empty(numel)
+    # An NHWC buffer viewed as NCHW has exactly the channels-last strides.
+    out = out.view(len(images), h, w, c).permute(0, 3, 1, 2)
+    for i, image in enumerate(images):
+        out[i] = image
+    return out, default_collate(idxs), default_collate(labels)
+
+
+class SharedImageCache:
+    """A fixed-size uint8 image array in shared memory, filled lazily.
+
+    The array is backed by a file in /dev/shm (RAM-backed on Linux) that is
+    unlinked as soon as it is mapped, so the memory is released when the last
+    process using it exits. DataLoader workers forked after construction inherit
+    the shared mapping: an image decoded by any worker is visible to all of them,
+    and later epochs read it from RAM instead of decoding it again.
+
+    The mapping is only shared with forked workers; a pickled np.memmap would be
+    a private copy. The cache therefore refuses to be pickled, which makes
+    DataLoader workers started with spawn fail instead of silently caching
+    separately.
+
+    Raises OSError if the space for the whole cache cannot be reserved.
+    """
+
+    def __init__(self, n, image_shape, dirname="/dev/shm"):
+        if not os.path.isdir(dirname):
+            dirname = tempfile.gettempdir()
+        image_shape = tuple(image_shape)
+        image_size = int(np.prod(image_shape))
+        nbytes = n + n * image_size
+        with tempfile.NamedTemporaryFile(prefix="dpdi_image_cache_", dir=dirname) as f:
+            # Reserve the space up front: on a full tmpfs (e.g. Docker's default 64MB
+            # /dev/shm), a write through the mapping would kill the worker with
+            # SIGBUS instead of raising here.
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, nbytes)
+            else:
+                st = os.statvfs(dirname)
+                if st.f_bavail * st.f_frsize < nbytes:
+                    raise OSError(errno.ENOSPC, "{} bytes needed in {}".format(
+                        nbytes, dirname))
+                f.truncate(nbytes)
+            # One byte per image, set once the image has been written.
+            self._flags = np.memmap(f.name, dtype=np.uint8, mode="r+", shape=(n,))
+            self._images = np.memmap(f.name, dtype=np.uint8, mode="r+", offset=n,
+                                     shape=(n,) + image_shape)
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __getstate__(self):
+        raise RuntimeError("SharedImageCache is only shared with DataLoader workers "
+                           "started with fork; set cache_images to False to use "
+                           "other start methods.")
+
+    def get(self, idx):
+        """Return a copy of the cached image at idx, or None if it is not cached."""
+        if not self._flags[idx]:
+            return None
+        return torch.from_numpy(np.array(self._images[idx]))
+
+    def put(self, idx, image):
+        self._images[idx] = image.numpy()
+        self._flags[idx] = 1
+
+
+class ImageFileDatasetMixin:
+    """Sample loading shared by the datasets that read image files by index.
+
+    Subclasses set self.loader, self.transform and self._abs_paths (the image
+    file of each sample), call _init_image_cache() in __init__, and implement
+    _get_label(idx).
+    """
+
+    def _init_image_cache(self, image_size, cache_images: bool):
+        """Set up the optional cache of images decoded and resized to image_size."""
+        self._resize = get_resize_transform(image_size)
+        self._image_size = list(image_size)
+        self._image_cache = None
+        if cache_images:
+            self.build_image_cache()
+
+    def build_image_cache(self):
+        """Allocate an empty image cache with one slot per sample in the dataset.
+
+        This replaces any existing cache. Call it before starting the DataLoader
+        workers, so that they share it.
+        """
+        # Release any existing cache before reserving the space for the new one.
+        self._image_cache = None
+        try:
+            self._image_cache = SharedImageCache(len(self), [3] + self._image_size)
+        except OSError as e:
+            print("[WARNING] could not allocate the image cache, reading images "
+                  "uncached: {}".format(e))
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        image = self._load_image(idx)
+        return self._make_sample(image, idx)
+
+    def __getitems__(self, idxs):
+        """Fetch a batch of samples, reading the images concurrently.
+
+        DataLoader calls this instead of __getitem__ when the dataset defines it.
+        The reads and JPEG decodes release the GIL, so they overlap in the
+        thread pool.
+        """
+        images = get_read_pool().map(self._load_image, idxs)
+        return [self._make_sample(image, idx) for image, idx in zip(images, idxs)]
+
+    def _load_image(self, idx):
+        if self._image_cache is None:
+            return self.loader(self._abs_paths[idx])
+        image = self._image_cache.get(idx)
+        if image is None:
+            image = self._resize(self.loader(self._abs_paths[idx]))
+            self._image_cache.put(idx, image)
+        return image
+
+    def _make_sample(self, image, idx):
+        label = self._get_label(idx)
+        if self.transform:
+            image = self.transform(image)
+        sample = (image, idx, label)
+        return sample
+
+
+class FastToTensor:
+    """Convert an 8-bit PIL image to a float CHW tensor in [0, 1].
+
+    Gives the same result as transforms.ToTensor() for RGB and L images, but
+    converts through a single numpy copy and an in-place division instead of
+    ToTensor's generic byte-buffer path.
+    """
+
+    def __call__(self, img):
+        a = np.array(img, dtype=np.uint8)
+        if a.ndim == 2:
+            a = a[:, :, None]
+        t = torch.from_numpy(a).permute(2, 0, 1).contiguous()
+        return t.to(torch.float32).div_(255)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
@@ -2,6 +2,7 @@ import torch
 import os
 from torchvision.datasets.folder import default_loader
 from torchvision import transforms
+from dpdi.datasets.utils import FastToTensor
 from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
 import pandas as pd
@@ -38,15 +39,15 @@ def get_zillow_transforms(is_train, normalize: bool = True):
     if is_train:  # Training dataset
         assert normalize, "Unnormalized train transform not implemented."
         return transforms.Compose([
-            center_crop, resize, rotate, flip, transforms.ToTensor(),
+            center_crop, resize, rotate, flip, FastToTensor(),
             normalize_transf
         ])
 
     else:
         if normalize:  # Normalized test dataset
-            return transforms.Compose([transforms.ToTensor(), normalize_transf])
+            return transforms.Compose([FastToTensor(), normalize_transf])
         else:  # Unnormalized test dataset
-            return transforms.Compose([transforms.ToTensor()])
+            return transforms.Compose([FastToTensor()])
 
 
 class ZillowDataset(Dataset):
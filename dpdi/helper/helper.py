@@ -20,6 +20,10 @@ class Helper:
         self.test_dataset = None
         self.poisoned_data = None
         self.test_data_poison = None
+        # Optional transforms applied to each batch of training/test inputs on the
+        # device.
+        self.train_batch_transform = None
+        self.test_batch_transform = None
 
         self.params = params
         self.name = name
@@ -15,12 +15,18 @@ import random
 from torchvision import datasets, transforms
 import numpy as np
 from dpdi.datasets.celeba_dataset import CelebADataset, get_celeba_transforms
-from dpdi.datasets.lfw_dataset import LFWDataset, get_lfw_transforms
+from dpdi.datasets.lfw_dataset import LFWDataset, get_lfw_transforms, LFW_MEAN, \
+    LFW_STD, LFW_CROP_SIZE
 from dpdi.datasets.mnist_dataset import MNISTWithAttributesDataset
 from dpdi.datasets.mc10_dataset import CIFAR10WithAttributesDataset
 from dpdi.datasets.zillow_dataset import ZillowDataset
 from dpdi.datasets.dsprites import DspritesDataset
-from dpdi.datasets.imdb_wiki import IMDBWikiDataset
+from dpdi.datasets.imdb_wiki import IMDBWikiDataset, IMDB_WIKI_MEAN, \
+    IMDB_WIKI_STD, IMDB_WIKI_CROP_SIZE
+from dpdi.datasets.batch_transforms import get_train_batch_transform, \
+    get_test_batch_transform
+from dpdi.datasets.samplers import ChunkShuffleSampler
+from dpdi.datasets.utils import collate_channels_last
 from collections import OrderedDict
 
 POISONED_PARTICIPANT_POS = 0
@@ -286,24 +292,26 @@ class ImageHelper(Helper):
             self.labels = list(range(10))
         return
 
-    def create_loaders(self):
+    def create_loaders(self, collate_fn=None):
         self.train_loader = torch.utils.data.DataLoader(self.train_dataset,
                                                         shuffle=True,
                                                         batch_size=self.params[
                                                             'batch_size'],
                                                         drop_last=True,
                                                         pin_memory=True,
-                                                        num_workers=8)
+                                                        num_workers=8,
+                                                        collate_fn=collate_fn)
         self.test_loader = torch.utils.data.DataLoader(self.test_dataset,
                                                        batch_size=self.params[
                                                            'test_batch_size'],
                                                        pin_memory=True,
                                                        num_workers=8,
-                                                       drop_last=True)
+                                                       drop_last=True,
+                                                       collate_fn=collate_fn)
         if hasattr(self, 'unnormalized_test_dataset'):
             self.unnormalized_test_loader = torch.utils.data.DataLoader(
                 self.unnormalized_test_dataset, batch_size=self.params['test_batch_size'],
-                num_workers=8, pin_memory=True, drop_last=True)
+                num_workers=8, pin_memory=True, drop_last=True, collate_fn=collate_fn)
 
 
     def balance_loaders(self):
@@ -351,15 +359,48 @@ class ImageHelper(Helper):
         self.dataset_size = len(self.train_dataset)
 
     def load_imdb_wiki_data(self):
+        # If packed_images is set, images are read from the array written by
+        # dpdi.datasets.imdb_wiki.pack_images() instead of the individual JPEGs.
+        packed = self.params.get('packed_images', False)
+        # If cache_images is set, decoded images are kept in shared memory after
+        # the first epoch. The unnormalized test set is read once per run and is
+        # not cached.
+        cache = self.params.get('cache_images', False)
         self.train_dataset = IMDBWikiDataset(self.params['root_dir'],
-                                             is_train=True, normalize=True)
+                                             is_train=True, device_normalize=True,
+                                             use_packed_images=packed)
         self.train_dataset.apply_alpha_to_dataset(self.params.get('alpha'),
                                                   self.params.get('n_train'))
+        if cache and not packed:
+            # Only reserve the cache for the training samples kept by
+            # apply_alpha_to_dataset.
+            self.train_dataset.build_image_cache()
+        # The batch transforms run in the main process, so unlike the per-sample
+        # transforms they can be scripted; each batch then runs through a single
+        # compiled module.
+        self.train_batch_transform = torch.jit.script(get_train_batch_transform(
+            IMDB_WIKI_MEAN, IMDB_WIKI_STD, IMDB_WIKI_CROP_SIZE))
+        self.test_batch_transform = torch.jit.script(get_test_batch_transform(
+            IMDB_WIKI_MEAN, IMDB_WIKI_STD))
         self.test_dataset = IMDBWikiDataset(self.params['root_dir'],
-                                            is_train=False, normalize=True)
+                                            is_train=False, device_normalize=True,
+                                            use_packed_images=packed,
+                                            cache_images=cache)
         self.unnormalized_test_dataset = IMDBWikiDataset(self.params['root_dir'],
-                                                         is_train=False, normalize=False)
-        self.create_loaders()
+                                                         is_train=False,
+                                                         device_normalize=False,
+                                                         use_packed_images=packed)
+        self.create_loaders(collate_fn=collate_channels_last)
+        if packed:
+            # Shuffle within buffers of contiguous chunks of the packed array.
+            sampler = ChunkShuffleSampler(
+                self.train_dataset.packed_idxs,
+                chunk_size=self.params['batch_size'],
+                chunks_per_buffer=self.params.get('shuffle_buffer_chunks', 16))
+            self.train_loader = torch.utils.data.DataLoader(
+                self.train_dataset, sampler=sampler,
+                batch_size=self.params['batch_size'], drop_last=True,
+                pin_memory=True, num_workers=8, collate_fn=collate_channels_last)
         self.dataset_size = len(self.train_dataset)
 
     def load_celeba_data(self):
@@ -408,7 +449,12 @@ class ImageHelper(Helper):
     def load_lfw_data(self):
         transform_train = get_lfw_transforms('train')
         transform_test = get_lfw_transforms('test')
-        transform_test_unnormalized = get_lfw_transforms('test', normalize=False)
+        transform_test_unnormalized = get_lfw_transforms('test', device_normalize=False)
+        self.train_batch_transform = torch.jit.script(get_train_batch_transform(
+            LFW_MEAN, LFW_STD, LFW_CROP_SIZE))
+        self.test_batch_transform = torch.jit.script(get_test_batch_transform(
+            LFW_MEAN, LFW_STD))
+        cache = self.params.get('cache_images', False)
 
         self.train_dataset = LFWDataset(
             self.params['root_dir'],
@@ -416,7 +462,8 @@ class ImageHelper(Helper):
             self.params['attribute_colname'],
             self.params.get('label_threshold'),
             transform_train,
-            partition='train')
+            partition='train',
+            cache_images=cache)
 
         self.test_dataset = LFWDataset(
             self.params['root_dir'],
@@ -424,7 +471,8 @@ class ImageHelper(Helper):
             self.params['attribute_colname'],
             self.params.get('label_threshold'),
             transform_test,
-            partition='test')
+            partition='test',
+            cache_images=cache)
 
         self.unnormalized_test_dataset = LFWDataset(
             self.params['root_dir'],
@@ -442,7 +490,7 @@ class ImageHelper(Helper):
                     f"len_train: {len(self.train_dataset)}, "
                     f"len_test: {len(self.test_dataset)}")
 
-        self.create_loaders()
+        self.create_loaders(collate_fn=collate_channels_last)
 
     def create_model(self):
         return
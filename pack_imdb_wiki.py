@@ -0,0 +1,15 @@
+"""Pack the IMDB-Wiki images into a single array for use with packed_images: True.
+
+Usage: python3 pack_imdb_wiki.py --root_dir /path/to/imdb-wiki
+"""
+import argparse
+
+from dpdi.datasets.imdb_wiki import pack_images
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", required=True,
+                        help="Directory containing meta.csv and the images.")
+    parser.add_argument("--num_workers", default=8, type=int)
+    args = parser.parse_args()
+    pack_images(args.root_dir, num_workers=args.num_workers)
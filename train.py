@@ -16,6 +16,7 @@ from dpdi.models.simple import reseed
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
+from torchvision import transforms
 import yaml
 from dpdi.utils.text_load import *
 from dpdi.utils.utils import create_table, plot_confusion_matrix
@@ -138,7 +139,8 @@ def compute_channelwise_mean(dataset):
     sds = defaultdict(list)
     for (i, batch) in enumerate(dataset):
         x, _, _ = batch
-        # batch is a set of images of shape [b, c, h, w]
+        # batch is a set of images of shape [b, c, h, w]; scale uint8 images to [0, 1].
+        x = transforms.functional.convert_image_dtype(x, torch.float32)
         means[0].append(torch.mean(x[:, 0, ...]))
         sds[0].append(torch.std(x[:, 0, ...]))
         means[1].append(torch.mean(x[:, 1, ...]))
@@ -291,8 +293,10 @@ def test(net, epoch, name, testloader, vis=True, mse: bool = False,
                 inputs, idxs, labels = data
             else:
                 inputs, labels = data
-            inputs = inputs.to(device)
-            labels = labels.to(device)
+            inputs = inputs.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            if helper.test_batch_transform is not None:
+                inputs = helper.test_batch_transform(inputs)
             outputs = net(inputs)
 
             if labels_mapping:
@@ -417,8 +421,10 @@ def train_dp(trainloader, model, optimizer, epoch, sigma, alpha, labels_mapping=
         else:
             inputs, labels = data
 
-        inputs = inputs.to(device)
-        labels = labels.to(device)
+        inputs = inputs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        if helper.train_batch_transform is not None:
+            inputs = helper.train_batch_transform(inputs)
 
         optimizer.zero_grad()
 
@@ -502,8 +508,10 @@ def train(trainloader, model, optimizer, epoch, labels_mapping=None):
         else:
             inputs, labels = data
 
-        inputs = inputs.to(device)
-        labels = labels.to(device)
+        inputs = inputs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        if helper.train_batch_transform is not None:
+            inputs = helper.train_batch_transform(inputs)
         # zero the parameter gradients
         optimizer.zero_grad()
 